@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Parses EPBD XML data with the database replaced by a stub, to validate a file
+before applying it or to benchmark the parser without a database.
+
+@author: Chris Lucas
+"""
+
+import datetime
+import re
+from collections import Counter, defaultdict
+from time import perf_counter
+
+
+BOOLEANS = {'t', 'true', 'y', 'yes', 'on', '1',
+            'f', 'false', 'n', 'no', 'off', '0'}
+DATE_FORMATS = ('%Y-%m-%d', '%Y%m%d')
+MAX_EXAMPLES = 5
+
+
+def check_value(value, column_type):
+    """
+    Return True if value can be stored in a PostgreSQL column of column_type.
+    """
+    stripped = value.strip()
+    length = re.match(r'(?:char|varchar)\((\d+)\)$', column_type)
+    if length is not None:
+        # alleen spaties aan het einde mogen langer zijn dan de kolom
+        return len(value.rstrip(' ')) <= int(length.group(1))
+    elif column_type == 'int':
+        try:
+            return -2 ** 31 <= int(stripped) < 2 ** 31
+        except ValueError:
+            return False
+    elif column_type == 'real':
+        try:
+            float(stripped)
+            return True
+        except ValueError:
+            return False
+    elif column_type == 'boolean':
+        return stripped.lower() in BOOLEANS
+    elif column_type == 'date':
+        for date_format in DATE_FORMATS:
+            try:
+                datetime.datetime.strptime(stripped, date_format)
+                return True
+            except ValueError:
+                pass
+        return False
+    return True
+
+
+class DryRunCursor(object):
+    """
+    Stands in for a psycopg2 cursor, counting statements instead of
+    executing them.
+    """
+
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        # aangenomen dat elke INSERT en DELETE precies een rij raakt
+        self.rowcount = 1
+
+    def execute(self, query, values=None):
+        self.dry_run.statements[query.split()[0].upper()] += 1
+
+    def fetchone(self):
+        # alleen gebruikt om laatste_volgnummer op te vragen
+        return [self.dry_run.last_volgnummer or 0]
+
+    def copy_expert(self, query, f):
+        self.dry_run.statements['COPY'] += 1
+        f.seek(0)
+        self.dry_run.copy_rows += sum(1 for line in f)
+
+    def close(self):
+        pass
+
+
+class DryRunConnection(object):
+    """
+    Stands in for a psycopg2 connection.
+    """
+
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+
+    def cursor(self):
+        return DryRunCursor(self.dry_run)
+
+    def commit(self):
+        self.dry_run.statements['COMMIT'] += 1
+
+    def rollback(self):
+        self.dry_run.statements['ROLLBACK'] += 1
+
+    def set_session(self, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+class DryRun(object):
+    """
+    Replaces the database connection of a content handler by a stub and
+    collects statistics and schema violations of the parsed records.
+    """
+
+    def __init__(self, last_volgnummer=None):
+        self.last_volgnummer = last_volgnummer
+        self.statements = Counter()
+        self.copy_rows = 0
+        self.stuurcodes = Counter()
+        self.violations = Counter()
+        self.examples = defaultdict(list)
+        self.records = 0
+        self.input_size = 0
+        self.elapsed = 0.0
+        self.handler = None
+
+    def connect(self):
+        return DryRunConnection(self)
+
+    def instrument(self, handler):
+        """
+        Let handler connect to the stub and validate every record before it
+        is handled.
+        """
+        self.handler = handler
+        handler.connect = self.connect
+        if hasattr(handler, 'force_update'):
+            # het volgnummer wordt na afloop in het rapport gecontroleerd
+            handler.force_update = True
+
+        end_element = handler.endElement
+
+        def endElement(name):
+            if name == "Pandcertificaat":
+                self.check_record(handler)
+            end_element(name)
+        handler.endElement = endElement
+        return handler
+
+    def check_record(self, handler):
+        self.records += 1
+        stuurcode = getattr(handler, 'stuurcode', None)
+        self.stuurcodes[stuurcode] += 1
+        for name, value in handler.data.items():
+            if value != "" and not check_value(value, handler.Kolommen[name]):
+                self.violations[name] += 1
+                examples = self.examples[name]
+                if len(examples) < MAX_EXAMPLES and value not in examples:
+                    examples.append(value)
+
+    def start(self, input_size=0):
+        self.input_size = input_size
+        self.start_time = perf_counter()
+
+    def stop(self):
+        self.elapsed = perf_counter() - self.start_time
+
+    def check_volgnummer(self):
+        """
+        Return the outcome of the mutation number check the handler would
+        have done against last_volgnummer.
+        """
+        volgnummer = getattr(self.handler, 'volgnummer', None)
+        if volgnummer is None or self.last_volgnummer is None:
+            return 'not checked'
+        volgnummer = int(volgnummer)
+        if getattr(self.handler, 'region', None) is not None:
+            # een regio wordt alleen omgewisseld bij een gelijk volgnummer
+            if volgnummer != self.last_volgnummer:
+                return 'not equal to the last mutation number, the region would not be swapped'
+            return 'ok'
+        if volgnummer == self.last_volgnummer:
+            return 'equal to the last mutation number, nothing to apply'
+        elif volgnummer < self.last_volgnummer:
+            return 'lower than the last mutation number'
+        elif volgnummer > self.last_volgnummer + 1:
+            return 'more than 1 higher than the last mutation number'
+        return 'ok'
+
+    def report(self):
+        """
+        Return a summary of the parsed file.
+        """
+        lines = ['Records: {}'.format(self.records)]
+        if set(self.stuurcodes) != {None}:
+            for stuurcode in sorted(self.stuurcodes, key=str):
+                lines.append('  stuurcode {}: {}'.format(
+                    stuurcode, self.stuurcodes[stuurcode]))
+        volgnummer = getattr(self.handler, 'volgnummer', None)
+        lines.append('Mutation number: {} ({})'.format(
+            volgnummer, self.check_volgnummer()))
+
+        lines.append('Estimated statements: {}'.format(
+            sum(self.statements.values())))
+        for statement in sorted(self.statements):
+            lines.append('  {}: {}'.format(statement,
+                                           self.statements[statement]))
+        if self.copy_rows:
+            lines.append('  rows copied: {}'.format(self.copy_rows))
+
+        if self.violations:
+            lines.append('Schema violations: {}'.format(
+                sum(self.violations.values())))
+            for name in sorted(self.violations):
+                lines.append('  {} ({}): {}, e.g. {}'.format(
+                    name, self.handler.Kolommen[name], self.violations[name],
+                    ', '.join(repr(v) for v in self.examples[name])))
+        else:
+            lines.append('Schema violations: 0')
+
+        if self.elapsed > 0:
+            lines.append('Parsed in {:.3f} s: {:.0f} records/s, {:.2f} MB/s'.format(
+                self.elapsed, self.records / self.elapsed,
+                self.input_size / self.elapsed / 1e6))
+        return '\n'.join(lines)
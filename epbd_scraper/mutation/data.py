@@ -9,13 +9,21 @@ import logging
 import xml.etree.ElementTree
 import zipfile
 from io import BytesIO
-import requests
 
 
 logger = logging.getLogger(__name__)
 
 
-def get_url(date, username, password):
+class NotPublishedError(Exception):
+    def __init__(self, msg, date):
+        Exception.__init__(self, msg)
+        self.msg = msg
+        self.date = date
+
+
+def get_url(date, username, password, session=None):
+    import requests
+
     # request
     headers = {'content-type': 'text/xml',
                'SOAPAction': 'http://schemas.ep-online.nl/EpbdDownloadMutationFileService/DownloadMutationFile'}
@@ -38,21 +46,38 @@ def get_url(date, username, password):
     </soap:Body>
     </soap:Envelope>""".format(username, password, date)
 
-    r = requests.post("https://webapplicaties.agro.nl/DownloadMutationFile/EPBDDownloadMutationFile.asmx",
-                      data=req, headers=headers)
+    # reuse the connection of session if given
+    r = (session or requests).post("https://webapplicaties.agro.nl/DownloadMutationFile/EPBDDownloadMutationFile.asmx",
+                                   data=req, headers=headers)
 
-    # response
+    return read_url(r.content, date)
 
-    tree = xml.etree.ElementTree.fromstring(r.content)
+
+def read_url(content, date):
+    """
+    Return the download URL in the SOAP response content. Raises a
+    NotPublishedError if the response has no URL, as is the case until the
+    mutation file of date is published.
+    """
+    tree = xml.etree.ElementTree.fromstring(content)
     element = tree.find(
         './/{http://schemas.ep-online.nl/EpbdDownloadMutationFileResponse}downloadURL')
+    if element is None or not element.text:
+        fault = tree.find('.//{http://schemas.xmlsoap.org/soap/envelope/}Fault')
+        if fault is not None:
+            raise ValueError('Request for the mutation file of {} failed: {}'.format(
+                date, fault.findtext('faultstring')))
+        raise NotPublishedError(
+            'No download URL for the mutation file of {} yet.'.format(date), date)
     url = element.text
 
     return url
 
 
-def get_data(url, date):
-    r = requests.get(url)
+def get_data(url, date, session=None):
+    import requests
+
+    r = (session or requests).get(url)
     response_data = BytesIO(r.content)
     zipped_data = zipfile.ZipFile(response_data)
     try:
@@ -8,9 +8,10 @@ Based on epbdparser.py made by RVO.
 """
 
 import argparse
+import os
 import xml.sax
-import psycopg2
-from psycopg2.extensions import AsIs
+
+from epbd_scraper.partition import check_partition_digits, partition_table
 
 
 class EqualError(Exception):
@@ -44,7 +45,8 @@ class EpbdErrorHandler(xml.sax.ErrorHandler):
 # -----------------------------------------------------------------------------
 class EpbdContentHandler(xml.sax.ContentHandler):
     def __init__(self, host, dbname, schema_name, table_name,
-                 username, password='', port=5432, force_update=False):
+                 username, password='', port=5432, force_update=False,
+                 partition_digits=0, analyze_threshold=10000, vacuum=False):
         self.Kolommen = {"Pand_postcode": "char(6)",
                          "Pand_huisnummer": "int",
                          "Pand_huisnummer_toev": "varchar(7)",
@@ -69,18 +71,34 @@ class EpbdContentHandler(xml.sax.ContentHandler):
         self.schema_name = schema_name
         self.table_name = table_name
         self.force_update = force_update
+        check_partition_digits(partition_digits)
+        self.partition_digits = partition_digits
+        self.analyze_threshold = analyze_threshold
+        self.vacuum = vacuum
+        # aantal toegevoegde en verwijderde rijen, over alle documenten
+        self.rows_changed = 0
+        self.rows_since_analyze = 0
+        # het laatste volgnummer dat in de database is vastgelegd
+        self.last_applied_volgnummer = None
 
     # -------------------------------------------------------------------------
-    # aangeroepen bij de start van het document
+    # maakt een nieuwe connectie met de database
     # -------------------------------------------------------------------------
-    def startDocument(self):
-        # Connect met de database
+    def connect(self):
         conn_str = "host='{}' dbname='{}' user='{}' password='{}' port='{}'".format(self.host,
                                                                                     self.dbname,
                                                                                     self.user,
                                                                                     self.password,
                                                                                     self.port)
-        self.conn = psycopg2.connect(conn_str)
+        import psycopg2
+        return psycopg2.connect(conn_str)
+
+    # -------------------------------------------------------------------------
+    # aangeroepen bij de start van het document
+    # -------------------------------------------------------------------------
+    def startDocument(self):
+        # Connect met de database
+        self.conn = self.connect()
         self.cursor = self.conn.cursor()
 
         # als deze vlag waar wordt dan wordt data weg geschreven
@@ -99,9 +117,42 @@ class EpbdContentHandler(xml.sax.ContentHandler):
             self.data[name] = ""
 
         query = "SELECT * FROM\
-                 {}.laatste_volgnummer;".format(AsIs(self.schema_name))
+                 {}.laatste_volgnummer;".format(self.schema_name)
         self.cursor.execute(query)
         self.db_volgnummer = self.cursor.fetchone()[0]
+        self.last_applied_volgnummer = self.db_volgnummer
+
+    # -------------------------------------------------------------------------
+    # commit de transactie en werk daarna de statistieken van de tabel bij
+    # als er genoeg rijen veranderd zijn
+    # -------------------------------------------------------------------------
+    def commit(self):
+        self.conn.commit()
+        if self.analyze_threshold > 0 and self.rows_since_analyze >= self.analyze_threshold:
+            if self.vacuum:
+                # VACUUM kan niet binnen een transactie
+                query = "VACUUM ANALYZE {}.{};".format(self.schema_name,
+                                                       self.table_name)
+                self.conn.set_session(autocommit=True)
+                try:
+                    self.cursor.execute(query)
+                finally:
+                    self.conn.set_session(autocommit=False)
+            else:
+                query = "ANALYZE {}.{};".format(self.schema_name,
+                                                self.table_name)
+                self.cursor.execute(query)
+                self.conn.commit()
+            self.rows_since_analyze = 0
+
+    # -------------------------------------------------------------------------
+    # bepaalt de (partitie)tabel waar de huidige rij in thuis hoort
+    # -------------------------------------------------------------------------
+    def target_table(self):
+        if self.partition_digits == 0:
+            return self.table_name
+        return partition_table(self.table_name, self.data["Pand_postcode"],
+                               self.partition_digits)
 
     # -------------------------------------------------------------------------
     # aangeroepen bij de start van een nieuwe tag
@@ -172,11 +223,13 @@ class EpbdContentHandler(xml.sax.ContentHandler):
                 parameters = parameters[:-2] + ")"
 
                 query = "INSERT INTO {}.{}\
-                         {} VALUES {};".format(AsIs(self.schema_name),
-                                               AsIs(self.table_name),
+                         {} VALUES {};".format(self.schema_name,
+                                               self.target_table(),
                                                columns,
                                                parameters)
                 self.cursor.execute(query, values)
+                self.rows_changed += self.cursor.rowcount
+                self.rows_since_analyze += self.cursor.rowcount
             elif int(self.stuurcode) == 2:
                 values = [self.data["Pand_bagverblijfsobjectid"],
                           self.data["Pand_postcode"],
@@ -184,9 +237,11 @@ class EpbdContentHandler(xml.sax.ContentHandler):
                 query = "DELETE FROM {}.{} WHERE\
                         Pand_bagverblijfsobjectid = %s\
                         AND Pand_postcode = %s\
-                        AND Pand_huisnummer = %s;".format(AsIs(self.schema_name),
-                                                          AsIs(self.table_name))
+                        AND Pand_huisnummer = %s;".format(self.schema_name,
+                                                          self.target_table())
                 self.cursor.execute(query, values)
+                self.rows_changed += self.cursor.rowcount
+                self.rows_since_analyze += self.cursor.rowcount
 
             # initialiseer de buffer opnieuw door alle waardes leeg te maken
             for name in self.data.keys():
@@ -207,11 +262,12 @@ class EpbdContentHandler(xml.sax.ContentHandler):
         # gebruik het einde van het document om de connectie met de database
         # te sluiten
         query = "UPDATE {}.laatste_volgnummer\
-                 SET volgnummer = %s;".format(AsIs(self.schema_name))
+                 SET volgnummer = %s;".format(self.schema_name)
         self.cursor.execute(query, [self.volgnummer])
 
+        self.commit()
+        self.last_applied_volgnummer = self.volgnummer
         self.cursor.close()
-        self.conn.commit()
         self.conn.close()
 
 
@@ -252,8 +308,40 @@ def argument_parser():
     parser.add_argument('-f', '--force',
                         help='Force the update without checking the mutation number. WARNING: Could lead to an invalid dataset.',
                         action='store_true')
+    parser.add_argument('-n', '--partitiondigits',
+                        help='The number of postcode digits the table is partitioned on. Default: 0 (no partitioning)',
+                        type=int,
+                        required=False,
+                        default=0)
+    parser.add_argument('--analyzethreshold',
+                        help='Run ANALYZE on the table after committing a mutation file once this many rows have been inserted or deleted, also between the files of a catch-up. 0 to disable. Default: 10000',
+                        type=int,
+                        required=False,
+                        default=10000)
+    parser.add_argument('--vacuum',
+                        help='Run VACUUM ANALYZE instead of ANALYZE when the analyze threshold is reached.',
+                        action='store_true')
+    parser.add_argument('--dryrun',
+                        help='Parse and validate the file without connecting to the database, and report what would be done.',
+                        action='store_true')
+    parser.add_argument('--lastvolgnummer',
+                        help='With --dryrun, the last mutation number to check the mutation number of the file against.',
+                        type=int,
+                        required=False,
+                        default=None)
+    parser.add_argument('--profile',
+                        help='Report the number of calls and time spent per SAX callback and database call.',
+                        action='store_true')
+    parser.add_argument('--profileoutput',
+                        help='With --profile, also write cProfile stats to this path.',
+                        required=False,
+                        default=None)
 
     args = parser.parse_args()
+    try:
+        check_partition_digits(args.partitiondigits)
+    except ValueError as e:
+        parser.error(str(e))
     return args
 
 # -----------------------------------------------------------------------------
@@ -263,12 +351,25 @@ def argument_parser():
 
 def main():
     args = argument_parser()
+    content_handler = EpbdContentHandler(args.host, args.dbname, args.schema,
+                                         args.table, args.user, args.password,
+                                         args.port, args.force,
+                                         args.partitiondigits,
+                                         args.analyzethreshold, args.vacuum)
+    if args.dryrun:
+        from epbd_scraper.dryrun import DryRun
+        dry_run = DryRun(args.lastvolgnummer)
+        dry_run.instrument(content_handler)
+        dry_run.start(os.path.getsize(args.input_path))
+    if args.profile:
+        from epbd_scraper.profiling import Profiler
+        profiler = Profiler(args.profileoutput)
+        profiler.instrument(content_handler)
+        profiler.start()
     # parser object aanmaken
     parser = xml.sax.make_parser()
     # voeg objecten toe voor verwerking van de tags en error afhandeling
-    parser.setContentHandler(EpbdContentHandler(args.host, args.dbname, args.schema,
-                                                args.table, args.user, args.password,
-                                                args.port, args.force))
+    parser.setContentHandler(content_handler)
     parser.setErrorHandler(EpbdErrorHandler())
     # parse het bron bestand
     with open(args.input_path, "r") as f:
@@ -276,6 +377,12 @@ def main():
         src.setByteStream(f)
         src.setEncoding("UTF-8")
         parser.parse(src)
+    if args.dryrun:
+        dry_run.stop()
+        print(dry_run.report())
+    if args.profile:
+        profiler.stop()
+        print(profiler.report())
 
 
 if __name__ == '__main__':
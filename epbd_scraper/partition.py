@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Naming of the postcode partitions of the EPBD table, shared by the full load
+and the mutations so both route rows to the same partitions.
+
+@author: Chris Lucas
+"""
+
+
+# partitie voor postcodes die niet met een geldige prefix beginnen (bv. leeg)
+DEFAULT_PARTITION = 'overig'
+# 2 cijfers geeft al 90 partities, bij het volledig inladen elk met een
+# eigen tijdelijk bestand
+MAX_PARTITION_DIGITS = 2
+
+
+def check_partition_digits(partition_digits):
+    """
+    Raise a ValueError if the table can not be partitioned on the first
+    partition_digits digits of the postcode. 0 means no partitioning.
+    """
+    if not 0 <= partition_digits <= MAX_PARTITION_DIGITS:
+        raise ValueError(
+            'The number of partition digits should be between 0 and {}, got {}.'.format(
+                MAX_PARTITION_DIGITS, partition_digits))
+
+
+def check_region(region, partition_digits):
+    """
+    Raise a ValueError if region is not the postcode prefix of one of the
+    partitions of a table partitioned on partition_digits digits.
+    """
+    check_partition_digits(partition_digits)
+    if partition_digits == 0 or region not in partition_prefixes(partition_digits):
+        raise ValueError(
+            'Region {} is not a valid postcode prefix of {} digits.'.format(
+                region, partition_digits))
+
+
+def partition_prefixes(partition_digits):
+    """
+    Return the postcode prefixes used as partition values. Dutch postcodes
+    never start with a zero, so the prefixes range from 1 (or 10, 100, ..)
+    up to and including 9 (or 99, 999, ..).
+    """
+    return [str(i) for i in range(10 ** (partition_digits - 1),
+                                  10 ** partition_digits)]
+
+
+def partition_name(table_name, prefix):
+    """
+    Return the name of the partition of table_name holding the postcodes
+    starting with prefix.
+    """
+    return '{}_{}'.format(table_name, prefix)
+
+
+def partition_table(table_name, postcode, partition_digits):
+    """
+    Return the name of the partition of table_name postcode belongs in. Uses
+    the postcode as is, like the left(Pand_postcode, n) partition key.
+    """
+    prefix = postcode[:partition_digits]
+    if len(prefix) == partition_digits and prefix.isdigit() and prefix[0] != '0':
+        return partition_name(table_name, prefix)
+    return partition_name(table_name, DEFAULT_PARTITION)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Low overhead counters and timers for the SAX content handlers and their
+database calls. Only used when a script is run with --profile, the handlers
+themselves are left untouched otherwise.
+
+@author: Chris Lucas
+"""
+
+import cProfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+
+CALLBACKS = ('startDocument', 'startElement', 'characters',
+             'endElement', 'endDocument')
+# key in db_times for the database calls made from other threads
+WORKER_THREADS = 'worker threads'
+
+
+class _Proxy(object):
+    """
+    Forwards all attributes to the wrapped psycopg2 object, except for the
+    methods which are timed. Needed because psycopg2 connections and cursors
+    do not allow setting attributes.
+    """
+
+    def __init__(self, wrapped, profiler, methods):
+        self._wrapped = wrapped
+        for method in methods:
+            if hasattr(wrapped, method):
+                setattr(self, method, profiler.wrap_db('db.' + method,
+                                                       getattr(wrapped, method)))
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+
+class Profiler(object):
+    """
+    Keeps the number of calls and the cumulative time per name.
+    """
+
+    def __init__(self, cprofile_path=None):
+        self.counts = defaultdict(int)
+        self.times = defaultdict(float)
+        # time spent in database calls per callback they are made from
+        self.db_times = defaultdict(float)
+        self.callback = None
+        # database calls are also made from the COPY worker threads, those
+        # overlap in time and are not attributed to a callback
+        self.db_lock = threading.Lock()
+        self.thread = threading.get_ident()
+        self.cprofile_path = cprofile_path
+        self.cprofile = None
+
+    def wrap(self, name, func):
+        """
+        Return func wrapped with a counter and timer under name.
+        """
+        counts = self.counts
+        times = self.times
+
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                times[name] += perf_counter() - start
+                counts[name] += 1
+        return wrapper
+
+    def wrap_callback(self, name, func):
+        """
+        Like wrap, but also registers name as the callback database calls
+        are made from.
+        """
+        func = self.wrap(name, func)
+
+        def wrapper(*args, **kwargs):
+            previous = self.callback
+            self.callback = name
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.callback = previous
+        return wrapper
+
+    def wrap_db(self, name, func):
+        """
+        Like wrap, but also adds the time to the callback the call is made
+        from. Can be called from multiple threads, the time of calls from
+        other threads than the one the profiler was created in is kept under
+        WORKER_THREADS.
+        """
+        counts = self.counts
+        times = self.times
+        db_times = self.db_times
+        lock = self.db_lock
+
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                if threading.get_ident() == self.thread:
+                    callback = self.callback
+                else:
+                    callback = WORKER_THREADS
+                with lock:
+                    times[name] += elapsed
+                    counts[name] += 1
+                    db_times[callback] += elapsed
+        return wrapper
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Time a block of code under name.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += perf_counter() - start
+            self.counts[name] += 1
+
+    def instrument(self, handler):
+        """
+        Wrap the SAX callbacks of handler, and every connection it opens and
+        the cursors of those, with counters and timers. Should be done after
+        anything else replacing the connect method of handler.
+        """
+        for name in CALLBACKS:
+            setattr(handler, name, self.wrap_callback(name,
+                                                      getattr(handler, name)))
+
+        connect = handler.connect
+
+        def connect_profiled():
+            conn = connect()
+            proxy = _Proxy(conn, self, ('commit', 'rollback'))
+
+            def cursor(*args, **kwargs):
+                return _Proxy(conn.cursor(*args, **kwargs), self,
+                              ('execute', 'fetchone', 'copy_expert'))
+            proxy.cursor = cursor
+            return proxy
+        handler.connect = self.wrap_db('db.connect', connect_profiled)
+        return handler
+
+    def start(self):
+        if self.cprofile_path is not None:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def stop(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+
+    def report(self):
+        """
+        Return a per name breakdown of calls and cumulative time. The time of
+        the database calls is also included in the time of the callback they
+        are made from, so those callbacks are reported excluding them as well.
+        The database calls of worker threads overlap in time, so they are
+        reported separately and not subtracted.
+        """
+        lines = ['{:<24}{:>12}{:>12}{:>15}'.format('name', 'calls',
+                                                   'total (s)', 'per call (us)')]
+        for name in sorted(self.times, key=self.times.get, reverse=True):
+            lines.append('{:<24}{:>12}{:>12.3f}{:>15.1f}'.format(
+                name, self.counts[name], self.times[name],
+                1e6 * self.times[name] / self.counts[name]))
+
+        for name in CALLBACKS:
+            if self.db_times.get(name):
+                lines.append('{:<24}{:>12}{:>12.3f}'.format(
+                    name + ' excl. db', '',
+                    self.times[name] - self.db_times[name]))
+        if self.db_times.get(WORKER_THREADS):
+            lines.append('{:<24}{:>12}{:>12.3f}'.format(
+                'db in ' + WORKER_THREADS, '', self.db_times[WORKER_THREADS]))
+        if self.cprofile_path is not None:
+            lines.append('cProfile stats written to: {}'.format(
+                self.cprofile_path))
+        return '\n'.join(lines)
@@ -8,9 +8,64 @@ Based on epbdparser.py made by RVO.
 """
 
 import argparse
+import os
+import csv
+import tempfile
 import xml.sax
-import psycopg2
-from psycopg2.extensions import AsIs
+from concurrent.futures import ThreadPoolExecutor
+
+from epbd_scraper.partition import (DEFAULT_PARTITION, check_partition_digits,
+                                    check_region, partition_prefixes,
+                                    partition_name, partition_table)
+
+
+def copy_partition(connect, schema_name, table_name, columns, f):
+    """
+    COPY the CSV rows in file object f into schema_name.table_name using a
+    dedicated connection returned by connect, so multiple partitions can be
+    loaded in parallel.
+    """
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        query = "COPY {}.{} ({}) FROM STDIN WITH CSV;".format(schema_name,
+                                                               table_name,
+                                                               ', '.join(columns))
+        f.seek(0)
+        cursor.copy_expert(query, f)
+        cursor.close()
+        conn.commit()
+    finally:
+        conn.close()
+        f.close()
+
+
+def swap_partition(cursor, schema_name, table_name, prefix, new_table_name):
+    """
+    Replace the partition of table_name for the postcodes starting with prefix
+    by new_table_name. Should be run in a single transaction, so readers
+    either see the old or the new region.
+    """
+    partition = partition_name(table_name, prefix)
+    query = "ALTER TABLE {0}.{1} DETACH PARTITION {0}.{2};".format(schema_name,
+                                                                  table_name,
+                                                                  partition)
+    cursor.execute(query)
+    query = "DROP TABLE {}.{};".format(schema_name, partition)
+    cursor.execute(query)
+    query = "ALTER TABLE {}.{} RENAME TO {};".format(schema_name,
+                                                     new_table_name,
+                                                     partition)
+    cursor.execute(query)
+    query = "ALTER TABLE {0}.{1} ATTACH PARTITION {0}.{2}\
+             FOR VALUES IN (%s);".format(schema_name, table_name, partition)
+    cursor.execute(query, [prefix])
+
+
+class VolgnummerError(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+        self.msg = msg
 
 
 # -----------------------------------------------------------------------------
@@ -29,7 +84,9 @@ class EpbdErrorHandler(xml.sax.ErrorHandler):
 # -----------------------------------------------------------------------------
 class EpbdContentHandler(xml.sax.ContentHandler):
     def __init__(self, host, dbname, schema_name, table_name,
-                 username, password='', port=5432, chunk_size=1000):
+                 username, password='', port=5432, chunk_size=1000,
+                 partition_digits=0, workers=4, region=None,
+                 force_update=False):
         self.Kolommen = {"Pand_postcode": "char(6)",
                          "Pand_huisnummer": "int",
                          "Pand_huisnummer_toev": "varchar(7)",
@@ -56,17 +113,37 @@ class EpbdContentHandler(xml.sax.ContentHandler):
         self.chunk_size = chunk_size
         self.i = 0
 
+        # bij partitionering worden de rijen per partitie gebufferd en aan
+        # het einde van het document parallel met COPY ingeladen
+        if region is not None and partition_digits == 0:
+            partition_digits = len(region)
+        check_partition_digits(partition_digits)
+        if region is not None:
+            check_region(region, partition_digits)
+        self.partition_digits = partition_digits
+        self.workers = workers
+        self.region = region
+        # sla bij het verversen van een regio de controle van het volgnummer over
+        self.force_update = force_update
+
     # -------------------------------------------------------------------------
-    # aangeroepen bij de start van het document
+    # maakt een nieuwe connectie met de database
     # -------------------------------------------------------------------------
-    def startDocument(self):
-        # Connect met de database
+    def connect(self):
         conn_str = "host='{}' dbname='{}' user='{}' password='{}' port='{}'".format(self.host,
                                                                                     self.dbname,
                                                                                     self.user,
                                                                                     self.password,
                                                                                     self.port)
-        self.conn = psycopg2.connect(conn_str)
+        import psycopg2
+        return psycopg2.connect(conn_str)
+
+    # -------------------------------------------------------------------------
+    # aangeroepen bij de start van het document
+    # -------------------------------------------------------------------------
+    def startDocument(self):
+        # Connect met de database
+        self.conn = self.connect()
         self.cursor = self.conn.cursor()
 
         # als deze vlag waar wordt dan wordt data weg geschreven
@@ -81,28 +158,69 @@ class EpbdContentHandler(xml.sax.ContentHandler):
         self.data = {}
         for name in self.Kolommen:
             self.data[name] = ""
+        # per doeltabel een tijdelijk csv bestand voor COPY
+        self.buffers = {}
+
+        if self.region is not None:
+            # de regio mag alleen omgewisseld worden als het bestand even
+            # recent is als de rest van de tabel, anders gaan mutaties
+            # verloren of worden ze later dubbel toegepast
+            query = "SELECT * FROM\
+                     {}.laatste_volgnummer;".format(self.schema_name)
+            self.cursor.execute(query)
+            self.db_volgnummer = self.cursor.fetchone()[0]
+            self.checked_volgnummer = self.force_update
+
+            # alleen een nieuwe tabel voor de regio, deze wordt aan het einde
+            # van het document omgewisseld met de huidige partitie
+            self.region_table = partition_name(self.table_name,
+                                               self.region + '_nieuw')
+            # een eerdere mislukte run kan de tabel hebben achtergelaten
+            query = "DROP TABLE IF EXISTS {}.{};".format(self.schema_name,
+                                                         self.region_table)
+            self.cursor.execute(query)
+            query = "CREATE TABLE {0}.{1}\
+                     (LIKE {0}.{2});".format(self.schema_name,
+                                             self.region_table,
+                                             self.table_name)
+            self.cursor.execute(query)
+            return
 
         # Creeer een tabel in de database
-        query = "CREATE SCHEMA {}".format(AsIs(self.schema_name))
+        query = "CREATE SCHEMA {}".format(self.schema_name)
         self.cursor.execute(query)
 
-        parameters = '(' + ','.join(['%s %s' for i in self.Kolommen]) + ')'
-        query = "CREATE TABLE {}.{} {};".format(AsIs(self.schema_name),
-                                                AsIs(self.table_name),
+        parameters = '(' + ','.join(['{} {}'.format(key, value)
+                                     for key, value in self.Kolommen.items()]) + ')'
+        if self.partition_digits > 0:
+            parameters += " PARTITION BY LIST (left(Pand_postcode, {}))".format(
+                self.partition_digits)
+        query = "CREATE TABLE {}.{} {};".format(self.schema_name,
+                                                self.table_name,
                                                 parameters)
-        columns = []
-        for key, value in self.Kolommen.items():
-            columns.append(key)
-            columns.append(value)
-        columns = [AsIs(x) for x in columns]
-        self.cursor.execute(query, columns)
+        self.cursor.execute(query)
+
+        if self.partition_digits > 0:
+            for prefix in partition_prefixes(self.partition_digits):
+                query = "CREATE TABLE {0}.{1} PARTITION OF {0}.{2}\
+                         FOR VALUES IN (%s);".format(self.schema_name,
+                                                     partition_name(self.table_name,
+                                                                    prefix),
+                                                     self.table_name)
+                self.cursor.execute(query, [prefix])
+            # postcodes die niet in een partitie passen (bv. leeg)
+            query = "CREATE TABLE {0}.{1} PARTITION OF {0}.{2}\
+                     DEFAULT;".format(self.schema_name,
+                                      partition_name(self.table_name, DEFAULT_PARTITION),
+                                      self.table_name)
+            self.cursor.execute(query)
 
         query = "CREATE TABLE {}.laatste_volgnummer\
-                 (volgnummer int);".format(AsIs(self.schema_name))
+                 (volgnummer int);".format(self.schema_name)
         self.cursor.execute(query)
 
         query = "INSERT INTO {}.laatste_volgnummer\
-                 (volgnummer) VALUES (0);".format(AsIs(self.schema_name))
+                 (volgnummer) VALUES (0);".format(self.schema_name)
         self.cursor.execute(query)
 
     # -------------------------------------------------------------------------
@@ -135,7 +253,14 @@ class EpbdContentHandler(xml.sax.ContentHandler):
     # aangeroepen bij het einde van een tag
     # -------------------------------------------------------------------------
     def endElement(self, name):
-        if (name == "Pandcertificaat"):
+        if (name == "Pandcertificaat" and self.partition_digits > 0):
+            # schrijf de rij weg in de buffer van de juiste partitie
+            self.buffer_row()
+
+            # initialiseer de buffer opnieuw door alle waardes leeg te maken
+            for name in self.data.keys():
+                self.data[name] = ""
+        elif (name == "Pandcertificaat"):
             # Maak een query aan om de data in de database te zetten
             columns = "("
             parameters = "("
@@ -148,9 +273,8 @@ class EpbdContentHandler(xml.sax.ContentHandler):
             columns = columns[:-2] + ")"
             parameters = parameters[:-2] + ")"
 
-            query = "INSERT INTO {}.{} {} VALUES {};".format(AsIs(self.schema_name),
-                                                             AsIs(
-                                                                 self.table_name),
+            query = "INSERT INTO {}.{} {} VALUES {};".format(self.schema_name,
+                                                             self.table_name,
                                                              columns,
                                                              parameters)
             self.cursor.execute(query, values)
@@ -158,10 +282,17 @@ class EpbdContentHandler(xml.sax.ContentHandler):
             # initialiseer de buffer opnieuw door alle waardes leeg te maken
             for name in self.data.keys():
                 self.data[name] = ""
-        elif (name == "LaatstVerwerkteMutatieVolgnummer"):
+        elif (name == "LaatstVerwerkteMutatieVolgnummer" and self.region is None):
             query = "UPDATE {}.laatste_volgnummer\
-                     SET volgnummer = %s;".format(AsIs(self.schema_name))
+                     SET volgnummer = %s;".format(self.schema_name)
             self.cursor.execute(query, [self.volgnummer])
+        elif (name == "LaatstVerwerkteMutatieVolgnummer"):
+            if not self.force_update and int(self.volgnummer) != self.db_volgnummer:
+                self.abort_region(
+                    'LaatstVerwerkteMutatieVolgnummer ({}) niet gelijk aan het laatste '
+                    'volgnummer in de database ({}).'.format(int(self.volgnummer),
+                                                             self.db_volgnummer))
+            self.checked_volgnummer = True
 
         # na sluiten van een tag altijd de current waarde leeg maken
         self.current = ""
@@ -175,12 +306,75 @@ class EpbdContentHandler(xml.sax.ContentHandler):
             self.i = 0
             self.conn.commit()
 
+    # -------------------------------------------------------------------------
+    # schrijft de huidige rij naar het csv bestand van de doeltabel
+    # -------------------------------------------------------------------------
+    def buffer_row(self):
+        table_name = partition_table(self.table_name, self.data["Pand_postcode"],
+                                     self.partition_digits)
+        if self.region is not None:
+            if table_name != partition_name(self.table_name, self.region):
+                return
+            table_name = self.region_table
+
+        if table_name not in self.buffers:
+            f = tempfile.TemporaryFile('w+', newline='', encoding='utf-8')
+            self.buffers[table_name] = (f, csv.writer(f))
+        self.buffers[table_name][1].writerow(self.data.values())
+
+    # -------------------------------------------------------------------------
+    # ruimt na een fout bij het verversen van een regio de nieuwe tabel op
+    # -------------------------------------------------------------------------
+    def drop_region_table(self):
+        self.conn.rollback()
+        query = "DROP TABLE IF EXISTS {}.{};".format(self.schema_name,
+                                                     self.region_table)
+        self.cursor.execute(query)
+        self.conn.commit()
+        self.cursor.close()
+        self.conn.close()
+        for f, _ in self.buffers.values():
+            f.close()
+
+    # -------------------------------------------------------------------------
+    # breekt het verversen van een regio af en ruimt de nieuwe tabel op
+    # -------------------------------------------------------------------------
+    def abort_region(self, msg):
+        self.drop_region_table()
+        raise VolgnummerError(msg)
+
     # -------------------------------------------------------------------------
     # aangeroepen bij het einde van het document
     # -------------------------------------------------------------------------
     def endDocument(self):
+        if self.region is not None and not self.checked_volgnummer:
+            self.abort_region(
+                'Geen LaatstVerwerkteMutatieVolgnummer gevonden in het bestand.')
+
         # gebruik het einde van het document om de connectie met de database
         # te sluiten
+        self.conn.commit()
+
+        try:
+            if self.partition_digits > 0:
+                # laad alle partities parallel, elk over een eigen connectie
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    futures = [executor.submit(copy_partition, self.connect,
+                                               self.schema_name, table_name,
+                                               list(self.data.keys()), f)
+                               for table_name, (f, _) in self.buffers.items()]
+                    for future in futures:
+                        future.result()
+
+            if self.region is not None:
+                swap_partition(self.cursor, self.schema_name, self.table_name,
+                               self.region, self.region_table)
+        except Exception:
+            # de nieuwe tabel is al gecommit, laat hem niet achter
+            if self.region is not None:
+                self.drop_region_table()
+            raise
+
         self.cursor.close()
         self.conn.commit()
         self.conn.close()
@@ -225,8 +419,44 @@ def argument_parser():
                         type=int,
                         required=False,
                         default=1000)
+    parser.add_argument('-n', '--partitiondigits',
+                        help='Partition the table on the first n digits of the postcode. Default: 0 (no partitioning)',
+                        type=int,
+                        required=False,
+                        default=0)
+    parser.add_argument('-w', '--workers',
+                        help='The number of partitions loaded in parallel. Default: 4',
+                        type=int,
+                        required=False,
+                        default=4)
+    parser.add_argument('-g', '--region',
+                        help='Only refresh the partition of the given postcode prefix, by swapping it with a newly loaded table. Requires an existing partitioned table, and a file with the same mutation number as the database.',
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--dryrun',
+                        help='Parse and validate the file without connecting to the database, and report what would be done.',
+                        action='store_true')
+    parser.add_argument('--lastvolgnummer',
+                        help='With --dryrun and --region, the last mutation number in the database to check the file against.',
+                        type=int,
+                        required=False,
+                        default=None)
+    parser.add_argument('--profile',
+                        help='Report the number of calls and time spent per SAX callback and database call.',
+                        action='store_true')
+    parser.add_argument('--profileoutput',
+                        help='With --profile, also write cProfile stats to this path.',
+                        required=False,
+                        default=None)
 
     args = parser.parse_args()
+    try:
+        check_partition_digits(args.partitiondigits)
+        if args.region is not None:
+            check_region(args.region, args.partitiondigits or len(args.region))
+    except ValueError as e:
+        parser.error(str(e))
     return args
 
 
@@ -235,12 +465,25 @@ def argument_parser():
 # -----------------------------------------------------------------------------
 def main():
     args = argument_parser()
+    content_handler = EpbdContentHandler(args.host, args.dbname, args.schema,
+                                         args.table, args.user, args.password,
+                                         args.port, args.chunksize,
+                                         args.partitiondigits, args.workers,
+                                         args.region)
+    if args.dryrun:
+        from epbd_scraper.dryrun import DryRun
+        dry_run = DryRun(args.lastvolgnummer)
+        dry_run.instrument(content_handler)
+        dry_run.start(os.path.getsize(args.input_path))
+    if args.profile:
+        from epbd_scraper.profiling import Profiler
+        profiler = Profiler(args.profileoutput)
+        profiler.instrument(content_handler)
+        profiler.start()
     # parser object aanmaken
     parser = xml.sax.make_parser()
     # voeg objecten toe voor verwerking van de tags en error afhandeling
-    parser.setContentHandler(EpbdContentHandler(args.host, args.dbname, args.schema,
-                                                args.table, args.user, args.password,
-                                                args.port, args.chunksize))
+    parser.setContentHandler(content_handler)
     parser.setErrorHandler(EpbdErrorHandler())
     # parse het bron bestand
     with open(args.input_path, "r") as f:
@@ -248,6 +491,12 @@ def main():
         src.setByteStream(f)
         src.setEncoding("UTF-8")
         parser.parse(src)
+    if args.dryrun:
+        dry_run.stop()
+        print(dry_run.report())
+    if args.profile:
+        profiler.stop()
+        print(profiler.report())
 
 
 if __name__ == '__main__':
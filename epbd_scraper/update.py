@@ -7,16 +7,94 @@
 import argparse
 import logging
 import datetime
+import json
+import threading
+import time
 import xml.sax
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from mutation.parse import EpbdContentHandler, EpbdErrorHandler, HigherError, LowerError, EqualError
-from mutation.data import get_url, get_data
+from epbd_scraper.mutation.parse import EpbdContentHandler, EpbdErrorHandler, HigherError, LowerError, EqualError
+from epbd_scraper.mutation.data import NotPublishedError, get_url, get_data
+from epbd_scraper.partition import check_partition_digits
 
 
 logger = logging.getLogger(__name__)
 
 
-def parse_multiple_days(data, date, user, password, content_handler, error_handler, success=False):
+class EventRecorder(xml.sax.ContentHandler):
+    """
+    Records the SAX events of a document, so it can be parsed once and
+    replayed into the content handlers of several targets.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def startDocument(self):
+        self.events.append(('startDocument', ()))
+
+    def startElement(self, name, attrs):
+        self.events.append(('startElement',
+                            (name, xml.sax.xmlreader.AttributesImpl(dict(attrs)))))
+
+    def characters(self, content):
+        self.events.append(('characters', (content,)))
+
+    def endElement(self, name):
+        self.events.append(('endElement', (name,)))
+
+    def endDocument(self):
+        self.events.append(('endDocument', ()))
+
+
+def parse(xml_data, content_handler, error_handler):
+    """
+    Parse xml_data with content_handler. xml_data is either the XML itself or
+    the events recorded from it by an EventRecorder.
+    """
+    if isinstance(xml_data, bytes):
+        xml.sax.parseString(xml_data, content_handler, error_handler)
+    else:
+        for method, args in xml_data:
+            getattr(content_handler, method)(*args)
+
+
+class MutationFiles(object):
+    """
+    Downloads and parses the mutation file of each date only once, shared by
+    all targets, including the earlier dates needed to catch up.
+    """
+
+    def __init__(self, user, password, session=None):
+        self.user = user
+        self.password = password
+        self.session = session
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def get(self, date):
+        with self.lock:
+            if date not in self.events:
+                xml_data = download(date, self.user, self.password,
+                                    self.session)
+                recorder = EventRecorder()
+                xml.sax.parseString(xml_data, recorder, EpbdErrorHandler())
+                self.events[date] = recorder.events
+            return self.events[date]
+
+
+def rollback(content_handler):
+    """
+    Roll back the transaction content_handler left open when it stopped on
+    the mutation number check, and close its cursor and connection.
+    """
+    content_handler.conn.rollback()
+    content_handler.cursor.close()
+    content_handler.conn.close()
+
+
+def parse_multiple_days(data, date, user, password, content_handler, error_handler, success=False,
+                        session=None, files=None):
 
     if data == {}:
         return
@@ -36,36 +114,299 @@ def parse_multiple_days(data, date, user, password, content_handler, error_handl
     if date in data:
         logger.info('Parsing mutation data of date: {} ..'.format(date))
         xml_data = data[date]
-        xml.sax.parseString(xml_data, content_handler, error_handler)
+        parse(xml_data, content_handler, error_handler)
         logger.info(
             'Parse complete. Data ({}) added to the database.'.format(date))
         data.pop(date)
         parse_multiple_days(data, date, user, password, content_handler,
-                            error_handler, success=True)
+                            error_handler, success=True, session=session, files=files)
     elif success:
         error_msg = 'Missing date in data.'
         logger.error(error_msg)
         raise ValueError(error_msg)
     else:
-        logger.info(
-            'Retrieving mutation data for date: {}, requesting url..'.format(date))
-        url = get_url(date, user, password)
-        logger.info('url retrieved: {}, downloading data..'.format(url))
-        xml_data = get_data(url, date)
-        logger.info('Download complete. Parsing data..')
+        if files is not None:
+            xml_data = files.get(date)
+        else:
+            logger.info(
+                'Retrieving mutation data for date: {}, requesting url..'.format(date))
+            url = get_url(date, user, password, session)
+            logger.info('url retrieved: {}, downloading data..'.format(url))
+            xml_data = get_data(url, date, session)
+            logger.info('Download complete. Parsing data..')
         try:
-            xml.sax.parseString(xml_data, content_handler, error_handler)
+            parse(xml_data, content_handler, error_handler)
             logger.info(
                 'Parse complete. Data ({}) added to the database.'.format(date))
             parse_multiple_days(data, date, user, password, content_handler,
-                                error_handler, success=True)
+                                error_handler, success=True, session=session, files=files)
         except HigherError:
+            rollback(content_handler)
             logger.info('Parse failed. '
                         'Latest Mutation number in database does not match mutation number of data.'
                         'Trying data from an earlier date..')
             data[date] = xml_data
             parse_multiple_days(data, date, user, password, content_handler,
-                                error_handler, success=False)
+                                error_handler, success=False, session=session, files=files)
+
+
+def download(date, user, password, session=None):
+    """
+    Retrieve the XML mutation data of date.
+    """
+    logger.info(
+        'Retrieving mutation data for date: {}, requesting url..'.format(date))
+
+    try:
+        url = get_url(date, user, password, session)
+    except NotPublishedError:
+        raise
+    except Exception as e:
+        logger.exception("Error retrieving url")
+        raise e
+
+    logger.info('url retrieved: {}, downloading data..'.format(url))
+
+    try:
+        xml_data = get_data(url, date, session)
+    except Exception as e:
+        logger.exception("Error retrieving data")
+        raise e
+
+    logger.info('Download complete. Parsing data..')
+    return xml_data
+
+
+def apply_mutations(xml_data, date, user, password, content_handler, error_handler,
+                    session=None, files=None):
+    """
+    Parse the XML mutation data of date into the database. Falls back to the
+    data of earlier dates if the database is more than one mutation behind.
+    Returns False if the database was already up to date.
+    """
+    try:
+        parse(xml_data, content_handler, error_handler)
+        logger.info(
+            'Parse complete. Data ({}) added to the database.'.format(date))
+    except HigherError:
+        rollback(content_handler)
+        logger.info('Parse failed. '
+                    'Latest Mutation number in database does not match mutation number of data.'
+                    ' Trying data from an earlier date..')
+        data = {date: xml_data}
+        parse_multiple_days(data, date, user, password,
+                            content_handler, error_handler, session=session, files=files)
+    except LowerError:
+        rollback(content_handler)
+        logger.error('Parse failed. '
+                     'Data in database more recent than retrieved data.')
+        return False
+    except EqualError:
+        rollback(content_handler)
+        logger.error('Parse failed. '
+                     'Data in database already up to date with retrieved data.')
+        return False
+    return True
+
+
+def apply_to_targets(date, targets, files, error_handler):
+    """
+    Apply the mutation file of date to all targets concurrently. targets is a
+    list of (label, content handler) pairs, each handler checks the mutation
+    number of its own database and catches up on its own. The first target
+    is updated in the calling thread, so it can be profiled. Returns the
+    labels of the targets the data was added to.
+    """
+    events = files.get(date)
+    with ThreadPoolExecutor(max_workers=max(len(targets) - 1, 1)) as executor:
+        futures = [(label, executor.submit(apply_mutations, events, date,
+                                           files.user, files.password,
+                                           content_handler, error_handler,
+                                           files.session, files))
+                   for label, content_handler in targets[1:]]
+
+        label, content_handler = targets[0]
+        future = Future()
+        try:
+            future.set_result(apply_mutations(events, date, files.user,
+                                              files.password, content_handler,
+                                              error_handler, files.session,
+                                              files))
+        except Exception as e:
+            future.set_exception(e)
+        futures.insert(0, (label, future))
+
+    applied = []
+    failed = []
+    for label, future in futures:
+        try:
+            if future.result():
+                applied.append(label)
+        except Exception:
+            logger.exception('Error updating target {}'.format(label))
+            failed.append(label)
+    if failed:
+        raise RuntimeError('Update failed for targets: {}'.format(
+            ', '.join(failed)))
+    return applied
+
+
+class WarmConnection(object):
+    """
+    Keeps a single database connection open for all files parsed by a
+    content handler. Use as the connect method of the handler, closing the
+    connection at the end of a document is ignored.
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self.conn = None
+
+    def __call__(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = self._connect()
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def close(self):
+        pass
+
+
+class Status(object):
+    """
+    State of the daemon, as reported by the status endpoint.
+    """
+
+    def __init__(self):
+        self.started = datetime.datetime.now()
+        self.last_poll = None
+        self.last_date = None
+        # laatste volgnummer per target
+        self.volgnummers = {}
+        self.last_applied = None
+        # de datum waarvan het bestand nog niet gepubliceerd is
+        self.pending = None
+        self.error = None
+
+    def as_dict(self):
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        lag_days = None
+        if self.last_date is not None:
+            lag_days = (yesterday - datetime.date(
+                *[int(t) for t in self.last_date.split('-')])).days
+
+        def timestamp(value):
+            return None if value is None else value.isoformat(timespec='seconds')
+
+        volgnummers = dict(self.volgnummers)
+        if self.error is not None:
+            state = 'error'
+        elif self.pending is not None:
+            state = 'pending'
+        else:
+            state = 'ok'
+        return {'status': state,
+                'started': timestamp(self.started),
+                'last_poll': timestamp(self.last_poll),
+                'last_date': self.last_date,
+                'last_volgnummer': min(volgnummers.values()) if volgnummers else None,
+                'targets': volgnummers,
+                'last_applied': timestamp(self.last_applied),
+                'pending': self.pending,
+                'lag_days': lag_days,
+                'error': self.error}
+
+
+def serve_status(status, port):
+    """
+    Serve status as JSON on localhost:port in a background thread.
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(status.as_dict()).encode('utf-8')
+            self.send_response(200 if status.error is None else 503)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = HTTPServer(('127.0.0.1', port), StatusHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info('Serving status on http://127.0.0.1:{}/'.format(port))
+    return server
+
+
+def run_daemon(args, targets, error_handler):
+    """
+    Poll for the mutation file of yesterday every args.interval seconds and
+    apply it to all targets as soon as it is published. The database
+    connections and HTTP session are kept open between polls.
+    """
+    import requests
+
+    session = requests.Session()
+    connections = []
+    for label, content_handler in targets:
+        connection = WarmConnection(content_handler.connect)
+        content_handler.connect = connection
+        connections.append(connection)
+    status = Status()
+    if args.statusport:
+        serve_status(status, args.statusport)
+
+    while True:
+        date = str(datetime.date.today() - datetime.timedelta(days=1))
+        status.last_poll = datetime.datetime.now()
+        if date != status.last_date:
+            files = MutationFiles(args.epbduser, args.epbdpassword, session)
+            try:
+                if apply_to_targets(date, targets, files, error_handler):
+                    status.last_applied = datetime.datetime.now()
+                status.last_date = date
+                status.pending = None
+                status.error = None
+            except Exception as e:
+                if isinstance(e, NotPublishedError) and e.date == date:
+                    # verwacht tot het bestand 's ochtends gepubliceerd wordt
+                    logger.info('Mutation file of {} not published yet, retrying in {} seconds'.format(
+                        date, args.interval))
+                    status.pending = date
+                    status.error = None
+                else:
+                    logger.exception('Update of {} failed, retrying in {} seconds'.format(
+                        date, args.interval))
+                    status.error = '{}: {}'.format(type(e).__name__, e)
+                for connection in connections:
+                    if connection.conn is not None and not connection.conn.closed:
+                        connection.conn.rollback()
+            for label, content_handler in targets:
+                if content_handler.last_applied_volgnummer is not None:
+                    status.volgnummers[label] = content_handler.last_applied_volgnummer
+        time.sleep(args.interval)
+
+
+def parse_target(target, port):
+    """
+    Return the host, port, database, schema and table of a target given as
+    HOST[:PORT]/DBNAME/SCHEMA/TABLE.
+    """
+    parts = target.split('/')
+    if len(parts) != 4 or '' in parts:
+        raise ValueError(
+            'Invalid target {}, expected HOST[:PORT]/DBNAME/SCHEMA/TABLE.'.format(target))
+    host, dbname, schema, table = parts
+    if ':' in host:
+        host, port = host.rsplit(':', 1)
+        port = int(port)
+    return host, port, dbname, schema, table
 
 
 def argument_parser():
@@ -74,28 +415,37 @@ def argument_parser():
     """
     description = ("Updates a EPBD postgresql database with daily mutations.")
     parser = argparse.ArgumentParser(description=description)
+    target_named = parser.add_argument_group(
+        'target arguments',
+        'The database to update. -o, -d, -s and -t are required unless at least '
+        'one -x/--target is given, -pu is always required. None of them are '
+        'needed with --dryrun.')
+    target_named.add_argument('-o', '--host',
+                              help='The host adress of the PostgreSQL database.',
+                              required=False)
+    target_named.add_argument('-d', '--dbname',
+                              help='The name of the database to write to.',
+                              required=False)
+    target_named.add_argument('-s', '--schema',
+                              help='The name of the schema to write to.',
+                              required=False)
+    target_named.add_argument('-t', '--table',
+                              help='The name of the table to write to.',
+                              required=False)
+    target_named.add_argument('-pu', '--psqluser',
+                              help='The username to access the PostgreSQL database.',
+                              required=False)
     required_named = parser.add_argument_group('required named arguments')
-    required_named.add_argument('-o', '--host',
-                                help='The host adress of the PostgreSQL database.',
-                                required=True)
-    required_named.add_argument('-d', '--dbname',
-                                help='The name of the database to write to.',
-                                required=True)
-    required_named.add_argument('-s', '--schema',
-                                help='The name of the schema to write to.',
-                                required=True)
-    required_named.add_argument('-t', '--table',
-                                help='The name of the table to write to.',
-                                required=True)
-    required_named.add_argument('-pu', '--psqluser',
-                                help='The username to access the PostgreSQL database.',
-                                required=True)
     required_named.add_argument('-eu', '--epbduser',
                                 help='The username to access the EPBD SOAP API.',
                                 required=True)
     required_named.add_argument('-ep', '--epbdpassword',
                                 help='The password to access the EPBD SOAP API.',
                                 required=True)
+    parser.add_argument('-x', '--target',
+                        help='An additional database to update, as HOST[:PORT]/DBNAME/SCHEMA/TABLE. Can be repeated. Each mutation file is downloaded and parsed once and applied to all targets concurrently.',
+                        action='append',
+                        default=[])
     parser.add_argument('-pp', '--psqlpassword',
                         help='The password to access the PostgreSQL database. Defaults to empty password.',
                         required=False,
@@ -116,8 +466,82 @@ def argument_parser():
     parser.add_argument('-f', '--force',
                         help='Force the update without checking the mutation number. WARNING: Could lead to an invalid dataset.',
                         action='store_true')
+    parser.add_argument('-n', '--partitiondigits',
+                        help='The number of postcode digits the table is partitioned on. Default: 0 (no partitioning)',
+                        type=int,
+                        required=False,
+                        default=0)
+    parser.add_argument('--analyzethreshold',
+                        help='Run ANALYZE on the table after committing a mutation file once this many rows have been inserted or deleted, also between the files of a catch-up. 0 to disable. Default: 10000',
+                        type=int,
+                        required=False,
+                        default=10000)
+    parser.add_argument('--vacuum',
+                        help='Run VACUUM ANALYZE instead of ANALYZE when the analyze threshold is reached.',
+                        action='store_true')
+    parser.add_argument('--daemon',
+                        help='Keep running and apply new mutation files as soon as they are published. The date argument is ignored.',
+                        action='store_true')
+    parser.add_argument('--interval',
+                        help='With --daemon, the number of seconds between polls for a new mutation file. Default: 900',
+                        type=int,
+                        required=False,
+                        default=900)
+    parser.add_argument('--statusport',
+                        help='With --daemon, the local port to serve the status on, 0 to disable. Default: 8000',
+                        type=int,
+                        required=False,
+                        default=8000)
+    parser.add_argument('--dryrun',
+                        help='Download and validate the mutation file of the date without connecting to the database, and report what would be done.',
+                        action='store_true')
+    parser.add_argument('--lastvolgnummer',
+                        help='With --dryrun, the last mutation number to check the mutation number of the file against.',
+                        type=int,
+                        required=False,
+                        default=None)
+    parser.add_argument('--profile',
+                        help='Report the number of calls and time spent per SAX callback and database call. Only the first target is profiled.',
+                        action='store_true')
+    parser.add_argument('--profileoutput',
+                        help='With --profile, also write cProfile stats to this path.',
+                        required=False,
+                        default=None)
 
     args = parser.parse_args()
+    try:
+        check_partition_digits(args.partitiondigits)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.daemon and args.dryrun:
+        parser.error('argument --dryrun: not allowed with argument --daemon')
+    if args.daemon and args.profile:
+        parser.error('argument --profile: not allowed with argument --daemon')
+
+    args.targets = []
+    named = [args.host, args.dbname, args.schema, args.table]
+    if None not in named:
+        args.targets.append((args.host, args.port, args.dbname,
+                             args.schema, args.table))
+    elif named != [None] * 4 or not (args.target or args.dryrun):
+        parser.error('the following arguments are required: '
+                     '-o/--host, -d/--dbname, -s/--schema, -t/--table '
+                     '(or at least one -x/--target)')
+    for target in args.target:
+        try:
+            args.targets.append(parse_target(target, args.port))
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.dryrun:
+        # er wordt geen verbinding gemaakt, de target bepaalt alleen de namen
+        # in de geschatte statements
+        if len(args.targets) > 1:
+            parser.error('argument --dryrun: only one target can be checked')
+        if not args.targets:
+            args.targets.append(('', args.port, '', '', ''))
+    elif args.psqluser is None:
+        parser.error('the following arguments are required: -pu/--psqluser')
     return args
 
 
@@ -143,51 +567,63 @@ def main():
     # if int(date.split('-')[2]) == 1:
     #     logging.info('First day of the month, refreshing entire dataset..')
 
-    logger.info(
-        'Retrieving mutation data for date: {}, requesting url..'.format(date))
-
     try:
-        url = get_url(date, args.epbduser, args.epbdpassword)
+        targets = []
+        for host, port, dbname, schema, table in args.targets:
+            label = '{}:{}/{}/{}/{}'.format(host, port, dbname, schema, table)
+            content_handler = EpbdContentHandler(host, dbname, schema, table,
+                                                 args.psqluser, args.psqlpassword,
+                                                 port, args.force,
+                                                 args.partitiondigits,
+                                                 args.analyzethreshold, args.vacuum)
+            targets.append((label, content_handler))
+        error_handler = EpbdErrorHandler()
     except Exception as e:
-        logger.exception("Error retrieving url")
+        logger.exception("Error setting up xml parser")
         raise e
 
-    logger.info('url retrieved: {}, downloading data..'.format(url))
+    if args.dryrun:
+        # voor de profiler, zodat die de verbinding met de stub meet
+        from epbd_scraper.dryrun import DryRun
+        dry_run = DryRun(args.lastvolgnummer)
+        dry_run.instrument(targets[0][1])
 
-    try:
-        xml_data = get_data(url, date)
-    except Exception as e:
-        logger.exception("Error retrieving data")
-        raise e
+    if args.profile:
+        # alleen de eerste target, de tellers zijn niet thread safe
+        from epbd_scraper.profiling import Profiler
+        profiler = Profiler(args.profileoutput)
+        profiler.instrument(targets[0][1])
+        profiler.start()
 
-    logger.info('Download complete. Parsing data..')
+    if args.daemon:
+        run_daemon(args, targets, error_handler)
 
-    try:
-        content_handler = EpbdContentHandler(args.host, args.dbname, args.schema,
-                                             args.table, args.psqluser, args.psqlpassword,
-                                             args.port, args.force)
-        error_handler = EpbdErrorHandler()
-    except Exception as e:
-        logger.exception("Error setting up xml parser")
-        raise e
+    if args.dryrun:
+        xml_data = download(date, args.epbduser, args.epbdpassword)
+        dry_run.start(len(xml_data))
+        xml.sax.parseString(xml_data, targets[0][1], error_handler)
+        dry_run.stop()
+        report = dry_run.report()
+        print(report)
+        logger.info('Dry run ({}):\n{}'.format(date, report))
+    elif len(targets) == 1:
+        xml_data = download(date, args.epbduser, args.epbdpassword)
+        apply_mutations(xml_data, date, args.epbduser, args.epbdpassword,
+                        targets[0][1], error_handler)
+    else:
+        files = MutationFiles(args.epbduser, args.epbdpassword)
+        apply_to_targets(date, targets, files, error_handler)
 
-    try:
-        xml.sax.parseString(xml_data, content_handler, error_handler)
-        logger.info(
-            'Parse complete. Data ({}) added to the database.'.format(date))
-    except HigherError:
-        logger.info('Parse failed. '
-                    'Latest Mutation number in database does not match mutation number of data.'
-                    ' Trying data from an earlier date..')
-        data = {date: xml_data}
-        parse_multiple_days(data, date, args.epbduser, args.epbdpassword,
-                            content_handler, error_handler)
-    except LowerError:
-        logger.error('Parse failed. '
-                     'Data in database more recent than retrieved data.')
-    except EqualError:
-        logger.error('Parse failed. '
-                     'Data in database already up to date with retrieved data.')
+    if not args.dryrun:
+        for label, content_handler in targets:
+            logger.info('{} rows inserted or deleted in {}.'.format(
+                content_handler.rows_changed, label))
+
+    if args.profile:
+        profiler.stop()
+        report = profiler.report()
+        print(report)
+        logger.info('Profile:\n{}'.format(report))
 
 
 if __name__ == '__main__':
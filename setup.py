@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Chris Lucas
+"""
+
+from setuptools import setup, find_packages
+
+
+setup(
+    name='epbd_scraper',
+    description='Loads EPBD energy label data into a PostgreSQL database and keeps it up to date with daily mutations.',
+    author='Chris Lucas',
+    license='MIT',
+    packages=find_packages(),
+    python_requires='>=3.6',
+    install_requires=['psycopg2',
+                      'requests'],
+    entry_points={
+        'console_scripts': [
+            'epbd-total = epbd_scraper.total.parse:main',
+            'epbd-mutation = epbd_scraper.mutation.parse:main',
+            'epbd-update = epbd_scraper.update:main',
+        ],
+    },
+)
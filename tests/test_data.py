@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Chris Lucas
+"""
+
+import pytest
+
+from epbd_scraper.mutation.data import NotPublishedError, read_url
+
+
+def soap_response(body):
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+            '<soap:Body>{}</soap:Body></soap:Envelope>'.format(body)).encode()
+
+
+def test_read_url():
+    content = soap_response(
+        '<DownloadMutationFileResponse xmlns="http://schemas.ep-online.nl/EpbdDownloadMutationFileResponse">'
+        '<downloadURL>https://example.nl/d20200101.zip</downloadURL>'
+        '</DownloadMutationFileResponse>')
+    assert read_url(content, '2020-01-01') == 'https://example.nl/d20200101.zip'
+
+
+def test_read_url_not_published():
+    content = soap_response(
+        '<DownloadMutationFileResponse xmlns="http://schemas.ep-online.nl/EpbdDownloadMutationFileResponse">'
+        '<downloadURL /></DownloadMutationFileResponse>')
+    with pytest.raises(NotPublishedError) as e:
+        read_url(content, '2020-01-01')
+    assert e.value.date == '2020-01-01'
+    with pytest.raises(NotPublishedError):
+        read_url(soap_response(''), '2020-01-01')
+
+
+def test_read_url_fault():
+    content = soap_response('<soap:Fault><faultcode>soap:Client</faultcode>'
+                            '<faultstring>Invalid credentials</faultstring></soap:Fault>')
+    with pytest.raises(ValueError, match='Invalid credentials'):
+        read_url(content, '2020-01-01')
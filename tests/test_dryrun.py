@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Chris Lucas
+"""
+
+import xml.sax
+
+import pytest
+
+from epbd_scraper.dryrun import DryRun, check_value
+from epbd_scraper.mutation.parse import EpbdContentHandler as MutationContentHandler
+from epbd_scraper.total.parse import EpbdContentHandler as TotalContentHandler
+
+
+@pytest.mark.parametrize('value, column_type, expected', [
+    ('1234AB', 'varchar(6)', True),
+    ('1234ABC', 'varchar(6)', False),
+    ('A  ', 'char(1)', True),
+    (' A', 'char(1)', False),
+    ('1234AB\t', 'varchar(6)', False),
+    ('AB', 'char(1)', False),
+    ('42', 'int', True),
+    ('-2147483648', 'int', True),
+    ('2147483648', 'int', False),
+    ('4.2', 'int', False),
+    ('1.5', 'real', True),
+    ('1,5', 'real', False),
+    ('true', 'boolean', True),
+    ('N', 'boolean', True),
+    ('ja', 'boolean', False),
+    ('2020-02-29', 'date', True),
+    ('20200229', 'date', True),
+    ('2021-02-29', 'date', False),
+    ('29-02-2020', 'date', False),
+    ('anything', 'text', True),
+])
+def test_check_value(value, column_type, expected):
+    assert check_value(value, column_type) is expected
+
+
+REGION_DATA = (b'<Bestand><LaatstVerwerkteMutatieVolgnummer>5</LaatstVerwerkteMutatieVolgnummer>'
+               b'<Pandcertificaat><Pand_postcode>1234AB</Pand_postcode></Pandcertificaat>'
+               b'<Pandcertificaat><Pand_postcode>1334AB</Pand_postcode></Pandcertificaat>'
+               b'</Bestand>')
+
+
+@pytest.mark.parametrize('last_volgnummer, expected', [
+    (None, 'not checked'),
+    (5, 'ok'),
+    (4, 'not equal to the last mutation number, the region would not be swapped'),
+])
+def test_dry_run_region(last_volgnummer, expected):
+    handler = TotalContentHandler('host', 'db', 'schema', 'epbd', 'user',
+                                  region='12')
+    dry_run = DryRun(last_volgnummer)
+    dry_run.instrument(handler)
+    xml.sax.parseString(REGION_DATA, handler)
+    assert dry_run.records == 2
+    assert dry_run.copy_rows == 1
+    assert dry_run.check_volgnummer() == expected
+
+
+def mutatiebericht(stuurcode, postcode, huisnummer):
+    return ('<Mutatiebericht><Stuurcode>{}</Stuurcode><Pandcertificaat>'
+            '<Pand_postcode>{}</Pand_postcode><Pand_huisnummer>{}</Pand_huisnummer>'
+            '</Pandcertificaat></Mutatiebericht>'.format(stuurcode, postcode,
+                                                         huisnummer)).encode()
+
+
+MUTATION_DATA = (b'<Mutatiebestand><Mutatievolgnummer>42</Mutatievolgnummer>'
+                 + mutatiebericht(1, '1234AB', '1')
+                 + mutatiebericht(1, '1234AB', 'x')
+                 + mutatiebericht(2, '9999ZZ', '3')
+                 + b'</Mutatiebestand>')
+
+
+@pytest.mark.parametrize('last_volgnummer, expected', [
+    (None, 'not checked'),
+    (41, 'ok'),
+    (42, 'equal to the last mutation number, nothing to apply'),
+    (43, 'lower than the last mutation number'),
+    (40, 'more than 1 higher than the last mutation number'),
+])
+def test_dry_run_mutations(last_volgnummer, expected):
+    handler = MutationContentHandler('host', 'db', 'schema', 'epbd', 'user')
+    dry_run = DryRun(last_volgnummer)
+    dry_run.instrument(handler)
+    xml.sax.parseString(MUTATION_DATA, handler)
+
+    assert dry_run.stuurcodes == {1: 2, 2: 1}
+    assert dry_run.statements == {'SELECT': 1, 'INSERT': 2, 'DELETE': 1,
+                                  'UPDATE': 1, 'COMMIT': 1}
+    assert dry_run.violations == {'Pand_huisnummer': 1}
+    report = dry_run.report().splitlines()
+    assert report[:4] == ['Records: 3', '  stuurcode 1: 2', '  stuurcode 2: 1',
+                          'Mutation number: 42 ({})'.format(expected)]
+    assert 'Estimated statements: 6' in report
+    assert "  Pand_huisnummer (int): 1, e.g. 'x'" in report
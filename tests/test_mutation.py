@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Chris Lucas
+"""
+
+import pytest
+
+from epbd_scraper.mutation.parse import EpbdContentHandler
+
+
+class FakeConnection(object):
+    """
+    Stands in for a psycopg2 connection and cursor, keeping the statements
+    and whether they were executed in autocommit mode.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.autocommit = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, values=None):
+        self.calls.append((query, self.autocommit))
+
+    def commit(self):
+        self.calls.append(('COMMIT', self.autocommit))
+
+    def set_session(self, autocommit):
+        self.autocommit = autocommit
+
+
+def make_handler(**kwargs):
+    handler = EpbdContentHandler('host', 'db', 'schema', 'epbd', 'user',
+                                 **kwargs)
+    handler.conn = handler.cursor = FakeConnection()
+    return handler
+
+
+def test_commit_below_threshold():
+    handler = make_handler(analyze_threshold=100)
+    handler.rows_since_analyze = 99
+    handler.commit()
+    assert handler.conn.calls == [('COMMIT', False)]
+    assert handler.rows_since_analyze == 99
+
+
+def test_commit_analyze():
+    handler = make_handler(analyze_threshold=100)
+    handler.rows_since_analyze = 100
+    handler.commit()
+    assert handler.conn.calls == [('COMMIT', False),
+                                  ('ANALYZE schema.epbd;', False),
+                                  ('COMMIT', False)]
+    assert handler.rows_since_analyze == 0
+
+
+def test_commit_vacuum():
+    handler = make_handler(analyze_threshold=100, vacuum=True)
+    handler.rows_since_analyze = 150
+    handler.commit()
+    # VACUUM kan niet binnen een transactie
+    assert handler.conn.calls == [('COMMIT', False),
+                                  ('VACUUM ANALYZE schema.epbd;', True)]
+    assert not handler.conn.autocommit
+    assert handler.rows_since_analyze == 0
+
+
+def test_commit_vacuum_failure():
+    handler = make_handler(analyze_threshold=100, vacuum=True)
+    handler.rows_since_analyze = 100
+
+    def execute(query, values=None):
+        raise RuntimeError('VACUUM failed')
+    handler.cursor = type('Cursor', (), {'execute': staticmethod(execute)})()
+    with pytest.raises(RuntimeError):
+        handler.commit()
+    assert not handler.conn.autocommit
+
+
+def test_commit_disabled():
+    handler = make_handler(analyze_threshold=0)
+    handler.rows_since_analyze = 10 ** 6
+    handler.commit()
+    assert handler.conn.calls == [('COMMIT', False)]
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Chris Lucas
+"""
+
+import xml.sax
+
+import pytest
+
+from epbd_scraper.partition import (check_partition_digits, check_region,
+                                    partition_prefixes, partition_table)
+from epbd_scraper.total.parse import EpbdContentHandler
+
+
+def test_check_partition_digits():
+    for partition_digits in (0, 1, 2):
+        check_partition_digits(partition_digits)
+    for partition_digits in (-1, 3):
+        with pytest.raises(ValueError):
+            check_partition_digits(partition_digits)
+
+
+def test_check_region():
+    check_region('1', 1)
+    check_region('12', 2)
+    for region, partition_digits in (('12', 1), ('01', 2), ('1', 2),
+                                     ('1A', 2), ('', 0), ('123', 3)):
+        with pytest.raises(ValueError):
+            check_region(region, partition_digits)
+
+
+def test_partition_prefixes():
+    assert partition_prefixes(1) == [str(i) for i in range(1, 10)]
+    prefixes = partition_prefixes(2)
+    assert len(prefixes) == 90
+    assert prefixes[0] == '10' and prefixes[-1] == '99'
+
+
+@pytest.mark.parametrize('postcode, partition_digits, expected', [
+    ('1234AB', 1, 'epbd_1'),
+    ('1234AB', 2, 'epbd_12'),
+    ('9999ZZ', 2, 'epbd_99'),
+    ('', 1, 'epbd_overig'),
+    ('1', 2, 'epbd_overig'),
+    ('0123AB', 1, 'epbd_overig'),
+    (' 1234AB', 1, 'epbd_overig'),
+    ('AB1234', 2, 'epbd_overig'),
+])
+def test_partition_table(postcode, partition_digits, expected):
+    assert partition_table('epbd', postcode, partition_digits) == expected
+
+
+def buffered_tables(handler, postcodes):
+    """
+    Return the number of rows handler buffers per table for postcodes.
+    """
+    handler.buffers = {}
+    handler.data = {name: '' for name in handler.Kolommen}
+    for postcode in postcodes:
+        handler.data['Pand_postcode'] = postcode
+        handler.buffer_row()
+    tables = {}
+    for table, (f, _) in handler.buffers.items():
+        f.seek(0)
+        tables[table] = len(f.readlines())
+        f.close()
+    return tables
+
+
+def test_buffer_row():
+    handler = EpbdContentHandler('host', 'db', 'schema', 'epbd', 'user',
+                                 partition_digits=1)
+    tables = buffered_tables(handler, ['1234AB', '1000AA', '9999ZZ', ''])
+    assert tables == {'epbd_1': 2, 'epbd_9': 1, 'epbd_overig': 1}
+
+
+def test_buffer_row_region():
+    handler = EpbdContentHandler('host', 'db', 'schema', 'epbd', 'user',
+                                 region='12')
+    handler.region_table = 'epbd_12_nieuw'
+    tables = buffered_tables(handler, ['1234AB', '1299ZZ', '1300AA', ''])
+    assert tables == {'epbd_12_nieuw': 2}
+
+
+class FailingCopyConnection(object):
+    """
+    Keeps the executed statements, and fails on COPY.
+    """
+
+    def __init__(self, statements):
+        self.statements = statements
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, values=None):
+        self.statements.append(' '.join(query.split()))
+
+    def fetchone(self):
+        return [5]
+
+    def copy_expert(self, query, f):
+        raise RuntimeError('COPY failed')
+
+    def commit(self):
+        self.statements.append('COMMIT')
+
+    def rollback(self):
+        self.statements.append('ROLLBACK')
+
+    def close(self):
+        pass
+
+
+def test_region_failure_drops_table():
+    statements = []
+    handler = EpbdContentHandler('host', 'db', 'schema', 'epbd', 'user',
+                                 region='12')
+    handler.connect = lambda: FailingCopyConnection(statements)
+    with pytest.raises(RuntimeError):
+        xml.sax.parseString(
+            b'<Bestand><LaatstVerwerkteMutatieVolgnummer>5</LaatstVerwerkteMutatieVolgnummer>'
+            b'<Pandcertificaat><Pand_postcode>1234AB</Pand_postcode></Pandcertificaat>'
+            b'</Bestand>', handler)
+    drop = 'DROP TABLE IF EXISTS schema.epbd_12_nieuw;'
+    assert statements.index(drop) < statements.index(
+        'CREATE TABLE schema.epbd_12_nieuw (LIKE schema.epbd);')
+    assert statements[-3:] == ['ROLLBACK', drop, 'COMMIT']
+    assert not any(statement.startswith('ALTER') for statement in statements)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Chris Lucas
+"""
+
+import time
+import xml.sax
+
+from epbd_scraper.profiling import WORKER_THREADS, Profiler
+from epbd_scraper.total.parse import EpbdContentHandler
+
+
+class SlowCopyConnection(object):
+    """
+    Stands in for a psycopg2 connection and cursor, with a slow COPY.
+    """
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, values=None):
+        pass
+
+    def copy_expert(self, query, f):
+        time.sleep(0.05)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_instrument():
+    handler = EpbdContentHandler('host', 'db', 'schema', 'epbd', 'user',
+                                 partition_digits=1, workers=4)
+    handler.connect = SlowCopyConnection
+    profiler = Profiler()
+    profiler.instrument(handler)
+    xml.sax.parseString(
+        b'<Bestand>'
+        + b''.join(b'<Pandcertificaat><Pand_postcode>%d234AB</Pand_postcode>'
+                   b'</Pandcertificaat>' % i for i in range(1, 5))
+        + b'</Bestand>', handler)
+
+    # de hoofdconnectie en een per partitie
+    assert profiler.counts['db.connect'] == 5
+    assert profiler.counts['db.copy_expert'] == 4
+    assert profiler.counts['endElement'] == 9
+    # de DDL in startDocument wordt ook gemeten
+    assert profiler.db_times['startDocument'] > 0
+    # de overlappende COPYs worden niet van endDocument afgetrokken
+    assert profiler.db_times[WORKER_THREADS] >= 0.2
+    assert profiler.times['endDocument'] < 0.2
+    assert profiler.times['endDocument'] >= profiler.db_times['endDocument']
+    assert 'db in worker threads' in profiler.report()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Chris Lucas
+"""
+
+import datetime
+import sys
+import xml.sax
+
+import pytest
+
+from epbd_scraper.mutation.parse import EpbdContentHandler, EpbdErrorHandler
+from epbd_scraper.update import (EventRecorder, Status, WarmConnection,
+                                 apply_mutations, argument_parser, parse,
+                                 parse_target)
+
+
+XML_DATA = (b'<?xml version="1.0" encoding="UTF-8"?>'
+            b'<Mutatiebestand><Mutatievolgnummer>42</Mutatievolgnummer>'
+            b'<Mutatiebericht soort="pand"><Stuurcode>1</Stuurcode>'
+            b'<Pandcertificaat><Pand_postcode>1234AB</Pand_postcode>'
+            b'<Pand_huisnummer>1</Pand_huisnummer></Pandcertificaat>'
+            b'</Mutatiebericht></Mutatiebestand>')
+
+
+class CallLog(xml.sax.ContentHandler):
+    """
+    Keeps the SAX callbacks it receives.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def startDocument(self):
+        self.calls.append(('startDocument',))
+
+    def startElement(self, name, attrs):
+        self.calls.append(('startElement', name, dict(attrs)))
+
+    def characters(self, content):
+        self.calls.append(('characters', content))
+
+    def endElement(self, name):
+        self.calls.append(('endElement', name))
+
+    def endDocument(self):
+        self.calls.append(('endDocument',))
+
+
+def test_parse_target():
+    assert parse_target('db.example.nl/epbd/public/labels', 5432) == \
+        ('db.example.nl', 5432, 'epbd', 'public', 'labels')
+    assert parse_target('localhost:5433/epbd/public/labels', 5432) == \
+        ('localhost', 5433, 'epbd', 'public', 'labels')
+
+
+@pytest.mark.parametrize('target', [
+    'localhost/epbd/public',
+    'localhost/epbd/public/labels/extra',
+    'localhost//public/labels',
+    '',
+])
+def test_parse_target_invalid(target):
+    with pytest.raises(ValueError):
+        parse_target(target, 5432)
+
+
+def test_parse_target_invalid_port():
+    with pytest.raises(ValueError):
+        parse_target('localhost:port/epbd/public/labels', 5432)
+
+
+def test_replay():
+    direct = CallLog()
+    parse(XML_DATA, direct, EpbdErrorHandler())
+
+    recorder = EventRecorder()
+    parse(XML_DATA, recorder, EpbdErrorHandler())
+    replayed = [CallLog(), CallLog()]
+    for content_handler in replayed:
+        parse(recorder.events, content_handler, EpbdErrorHandler())
+
+    assert direct.calls[0] == ('startDocument',)
+    assert ('startElement', 'Mutatiebericht', {'soort': 'pand'}) in direct.calls
+    for content_handler in replayed:
+        assert content_handler.calls == direct.calls
+
+
+def parse_args(monkeypatch, args):
+    monkeypatch.setattr(sys, 'argv', ['epbd-update', '-eu', 'user', '-ep', 'password'] + args)
+    return argument_parser()
+
+
+def test_dry_run_arguments(monkeypatch):
+    assert len(parse_args(monkeypatch, ['--dryrun']).targets) == 1
+    assert parse_args(monkeypatch, ['--dryrun', '-x', 'localhost/epbd/public/labels']).targets == \
+        [('localhost', 5432, 'epbd', 'public', 'labels')]
+    for args in (['--dryrun', '-x', 'a/epbd/public/labels', '-x', 'b/epbd/public/labels'],
+                 ['-x', 'localhost/epbd/public/labels']):
+        with pytest.raises(SystemExit):
+            parse_args(monkeypatch, args)
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 1
+
+    def execute(self, query, values=None):
+        self.conn.calls.append(query.split()[0])
+
+    def fetchone(self):
+        return [self.conn.volgnummer]
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """
+    Stands in for a psycopg2 connection of a database at mutation number
+    volgnummer.
+    """
+
+    def __init__(self, volgnummer):
+        self.volgnummer = volgnummer
+        self.calls = []
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.calls.append('COMMIT')
+
+    def rollback(self):
+        self.calls.append('ROLLBACK')
+
+    def close(self):
+        self.calls.append('CLOSE')
+        self.closed = True
+
+
+def test_apply_mutations_up_to_date():
+    conn = FakeConnection(42)
+    handler = EpbdContentHandler('host', 'db', 'schema', 'epbd', 'user')
+    handler.connect = WarmConnection(lambda: conn)
+    assert apply_mutations(XML_DATA, '2020-01-01', 'user', 'password',
+                           handler, EpbdErrorHandler()) is False
+    # de transactie van de SELECT wordt afgesloten, de connectie blijft open
+    assert conn.calls == ['SELECT', 'ROLLBACK']
+    assert not conn.closed
+
+
+def test_status():
+    status = Status()
+    assert status.as_dict()['status'] == 'ok'
+    assert status.as_dict()['lag_days'] is None
+
+    three_days_ago = datetime.date.today() - datetime.timedelta(days=3)
+    status.last_date = str(three_days_ago)
+    status.volgnummers = {'a': 42, 'b': 41}
+    status.pending = str(three_days_ago + datetime.timedelta(days=2))
+    result = status.as_dict()
+    assert result['status'] == 'pending'
+    assert result['lag_days'] == 2
+    assert result['last_volgnummer'] == 41
+    assert result['targets'] == {'a': 42, 'b': 41}
+
+    status.error = 'RuntimeError: Update failed for targets: a'
+    assert status.as_dict()['status'] == 'error'
+
+
+def test_warm_connection():
+    connections = []
+
+    def connect():
+        connections.append(FakeConnection(42))
+        return connections[-1]
+
+    warm = WarmConnection(connect)
+    conn = warm()
+    conn.commit()
+    conn.close()
+    assert warm() is conn
+    assert len(connections) == 1
+    assert connections[0].calls == ['COMMIT']
+
+    # na een verbroken verbinding wordt opnieuw verbonden
+    connections[0].closed = True
+    warm()
+    assert len(connections) == 2